@@ -1,16 +1,22 @@
 import streamlit as st
 import asyncio
-import os
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+import threading
+import re
+from pathlib import Path
 import datetime as dt
+from collections import OrderedDict
 from typing import TypedDict, Annotated, Sequence
 
 # LangChain & LangGraph Imports
 from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolNode
-# --- IMPORT AIMessage ---
-# We now need AIMessage to correctly build the conversation history
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage, ToolMessage
+from langchain_core.caches import InMemoryCache
 from langchain_groq import ChatGroq
 
 # Import Google Calendar Tools from our other file
@@ -21,21 +27,32 @@ from google_calendar_tools import check_availability, book_appointment
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], lambda x, y: x + y]
 
-tools = [check_availability, book_appointment]
-tool_node = ToolNode(tools)
+class BoundedMemorySaver(MemorySaver):
+    """In-memory checkpointer that keeps at most ``max_threads`` conversations.
 
-model = ChatGroq(
-    temperature=0, 
-    model_name="llama3-70b-8192",
-    api_key=st.secrets.get("GROQ_API_KEY")
-)
-model = model.bind_tools(tools)
+    The least recently used conversation is dropped once the limit is reached,
+    since a Streamlit session that went away never comes back for its thread.
+    Only the public checkpointer API (put / delete_thread) is used.
+    """
+
+    def __init__(self, max_threads: int):
+        super().__init__()
+        self.max_threads = max_threads
+        self._recent_threads = OrderedDict()
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        saved_config = super().put(config, checkpoint, metadata, new_versions)
+        thread_id = config["configurable"]["thread_id"]
+        self._recent_threads[thread_id] = None
+        self._recent_threads.move_to_end(thread_id)
+        while len(self._recent_threads) > self.max_threads:
+            stale_thread_id, _ = self._recent_threads.popitem(last=False)
+            self.delete_thread(stale_thread_id)
+        return saved_config
 
-prompt = ChatPromptTemplate.from_messages(
-    [
-        (
-            "system",
-            """You are a helpful assistant that helps users book appointments in their Google Calendar.
+tools = [check_availability, book_appointment]
+
+SYSTEM_PROMPT = """You are a helpful assistant that helps users book appointments in their Google Calendar.
 Your primary tasks are to check for availability and book appointments.
 
 Conversation Flow:
@@ -52,16 +69,32 @@ Important Rules:
 - Always confirm with the user before calling the `book_appointment` tool.
 - If no slots are available, inform the user and ask if they'd like to try a different day or time.
 - Your final response after a successful booking should be a confirmation message, not a tool call.
-""",
-        ),
-        MessagesPlaceholder(variable_name="messages"),
-    ]
-).partial(current_date=str(dt.date.today()))
+"""
 
-agent_runnable = prompt | model
+class ToolFreeResponseCache(InMemoryCache):
+    """Exact-match cache for model replies that don't request a tool call.
 
-def run_agent(state: AgentState):
-    return {"messages": [agent_runnable.invoke(state)]}
+    With temperature=0, an identical prompt + message list gives an identical
+    reply, so greetings and clarifying questions can be served from memory.
+    Replies that call a tool are never cached, since the calendar may have
+    changed in the meantime.
+    """
+
+    def update(self, prompt, llm_string, return_val):
+        if any(getattr(getattr(gen, "message", None), "tool_calls", None) for gen in return_val):
+            return
+        super().update(prompt, llm_string, return_val)
+
+# The system message is rendered once and only rebuilt when the date changes, so
+# its bytes stay identical across turns (keeps Groq's prefix cache warm).
+_system_message_cache = {}
+
+def get_system_message():
+    today = str(dt.date.today())
+    if _system_message_cache.get("date") != today:
+        _system_message_cache["date"] = today
+        _system_message_cache["message"] = SystemMessage(content=SYSTEM_PROMPT.format(current_date=today))
+    return _system_message_cache["message"]
 
 def should_continue(state: AgentState):
     last_message = state["messages"][-1]
@@ -69,20 +102,119 @@ def should_continue(state: AgentState):
         return "action"
     return "end"
 
-workflow = StateGraph(AgentState)
-workflow.add_node("agent", run_agent)
-workflow.add_node("action", tool_node)
-workflow.set_entry_point("agent")
-workflow.add_conditional_edges("agent", should_continue, {"action": "action", "end": END})
-workflow.add_edge("action", "agent")
-agent_app = workflow.compile()
+# Turns that mention a date, a time or booking need the larger model to plan tool
+# calls; greetings and short confirmations are handled by the cheaper one.
+PLANNING_PATTERN = re.compile(
+    r"\d|\b(book|booking|booked|schedule|reschedule|appointments?|meetings?|available|availability|free|slots?|"
+    r"today|tomorrow|tonight|week|next|morning|afternoon|evening|noon|am|pm|"
+    r"monday|tuesday|wednesday|thursday|friday|saturday|sunday|"
+    r"jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)\b",
+    re.IGNORECASE,
+)
+
+def route_model(state: AgentState):
+    last_user_message = next(
+        (msg for msg in reversed(state["messages"]) if isinstance(msg, HumanMessage)), None
+    )
+    if last_user_message is None or PLANNING_PATTERN.search(last_user_message.content):
+        return "agent_smart"
+    return "agent_fast"
+
+# Only the last HISTORY_WINDOW or so messages are sent to the model verbatim;
+# older ones are folded into a short summary. The cut point moves in steps of
+# HISTORY_WINDOW so the prompt prefix stays unchanged between compactions.
+HISTORY_WINDOW = 8
+# Conversations the checkpointer keeps in memory before dropping the oldest
+MAX_CONVERSATIONS = 256
+SUMMARY_SNIPPET_CHARS = 200
+MAX_SUMMARY_LINES = 16
+
+def window_messages(messages):
+    messages = list(messages)
+    if len(messages) <= 2 * HISTORY_WINDOW:
+        return messages
+    cut = (len(messages) - HISTORY_WINDOW) // HISTORY_WINDOW * HISTORY_WINDOW
+    # Start the window on a user turn so tool calls stay paired with their results
+    while cut > 0 and not isinstance(messages[cut], HumanMessage):
+        cut -= 1
+    if cut == 0:
+        return messages
+
+    lines = []
+    for msg in reversed(messages[:cut]):
+        if len(lines) == MAX_SUMMARY_LINES:
+            break
+        if isinstance(msg, (HumanMessage, AIMessage)) and isinstance(msg.content, str) and msg.content:
+            speaker = "User" if isinstance(msg, HumanMessage) else "Assistant"
+            lines.append(f"- {speaker}: {msg.content[:SUMMARY_SNIPPET_CHARS]}")
+    summary = "Summary of the earlier conversation:\n" + "\n".join(reversed(lines))
+    return [SystemMessage(content=summary)] + messages[cut:]
+
+def messages_from_ui(ui_messages):
+    """Rebuilds a conversation from the chat history shown in the UI, used when
+    the checkpointer no longer has the thread (e.g. it was evicted)."""
+    return [
+        HumanMessage(content=msg["content"]) if msg["role"] == "user" else AIMessage(content=msg["content"])
+        for msg in ui_messages
+    ]
+
+def close_dangling_tool_calls(messages):
+    """Returns ToolMessages for tool calls an interrupted run left unanswered;
+    Groq rejects a conversation in which a tool call has no result."""
+    for i in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[i], AIMessage):
+            answered = {msg.tool_call_id for msg in messages[i + 1:] if isinstance(msg, ToolMessage)}
+            return [
+                ToolMessage(content="This tool call was interrupted and did not run.", tool_call_id=call["id"])
+                for call in messages[i].tool_calls
+                if call["id"] not in answered
+            ]
+    return []
+
+# Streamlit reruns this script on every interaction; caching the constructed
+# graph means the Groq client, tool bindings and compiled workflow are built
+# once per process instead of once per message.
+@st.cache_resource(show_spinner=False)
+def build_agent():
+    def make_model(model_name):
+        model = ChatGroq(
+            temperature=0, 
+            model_name=model_name,
+            api_key=st.secrets.get("GROQ_API_KEY"),
+            cache=ToolFreeResponseCache(maxsize=512),
+        )
+        return model.bind_tools(tools)
+
+    def make_agent_node(model):
+        async def run_agent(state: AgentState):
+            messages = [get_system_message()] + window_messages(state["messages"])
+            return {"messages": [await model.ainvoke(messages)]}
+
+        return run_agent
+
+    workflow = StateGraph(AgentState)
+    workflow.add_node("agent_fast", make_agent_node(make_model("llama3-8b-8192")))
+    workflow.add_node("agent_smart", make_agent_node(make_model("llama3-70b-8192")))
+    workflow.add_node("action", ToolNode(tools))
+    workflow.set_conditional_entry_point(
+        route_model, {"agent_fast": "agent_fast", "agent_smart": "agent_smart"}
+    )
+    workflow.add_conditional_edges("agent_fast", should_continue, {"action": "action", "end": END})
+    workflow.add_conditional_edges("agent_smart", should_continue, {"action": "action", "end": END})
+    # Tool results always go back to the larger model to interpret
+    workflow.add_edge("action", "agent_smart")
+    # The checkpointer keeps each session's conversation (keyed by thread_id),
+    # so every turn only has to send the new user message.
+    return workflow.compile(checkpointer=BoundedMemorySaver(max_threads=MAX_CONVERSATIONS))
 
 
 # --- 2. Streamlit Secrets and File Creation (No changes here) ---
 
+# Runs once per process: Streamlit's resource cache skips it on later reruns.
+@st.cache_resource(show_spinner=False)
 def setup_google_credentials():
-    if os.path.exists("credentials.json") and os.path.exists("token.json"):
-        return
+    if Path("credentials.json").is_file() and Path("token.json").is_file():
+        return True
     try:
         creds_json_str = st.secrets["gcp_service_account"]["credentials"]
         token_json_str = st.secrets["gcp_service_account"]["token"]
@@ -90,10 +222,26 @@ def setup_google_credentials():
             f.write(creds_json_str)
         with open("token.json", "w") as f:
             f.write(token_json_str)
+        return True
     except (KeyError, FileNotFoundError):
         st.error("Google credentials or token not found. Please configure them for deployment.")
         st.stop()
+
+# The Groq async client inside the cached graph binds its connection pool to the
+# first loop that uses it, so every session's graph runs go through this one
+# process-wide loop, which runs forever in a background thread.
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="agent-event-loop", daemon=True).start()
+    return loop
+
+def run_on_event_loop(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+# Credential files must exist before the agent (and its calendar tools) is used
 setup_google_credentials()
+agent_app = build_agent()
 
 
 # --- 3. Streamlit UI and Logic (Changes are here!) ---
@@ -108,44 +256,68 @@ if "messages" not in st.session_state:
 if "thread_id" not in st.session_state:
     st.session_state.thread_id = st.runtime.scriptrunner.get_script_run_ctx().session_id
 
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
+# Sending a message only reruns this fragment, not the page header, credential
+# setup and session initialisation above it.
+@st.fragment
+def chat_panel():
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
 
-if prompt := st.chat_input("What would you like to do?"):
-    st.session_state.messages.append({"role": "user", "content": prompt})
-    with st.chat_message("user"):
-        st.markdown(prompt)
+    if prompt := st.chat_input("What would you like to do?"):
+        st.session_state.messages.append({"role": "user", "content": prompt})
+        with st.chat_message("user"):
+            st.markdown(prompt)
 
-    with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            config = {"configurable": {"thread_id": st.session_state.thread_id}}
+        with st.chat_message("assistant"):
+            with st.spinner("Thinking..."):
+                config = {"configurable": {"thread_id": st.session_state.thread_id}}
             
-            # --- THE FIX: CONSTRUCT FULL HISTORY ---
-            # Convert our session state message list into a list of LangChain message objects
-            history = []
-            for msg in st.session_state.messages:
-                if msg["role"] == "user":
-                    history.append(HumanMessage(content=msg["content"]))
-                elif msg["role"] == "assistant":
-                    # Important: We need to use AIMessage for the assistant's replies
-                    history.append(AIMessage(content=msg["content"]))
-
-            # Pass the entire conversation history to the agent
-            inputs = {"messages": history}
-            # --- END OF FIX ---
+                # The checkpointer normally holds earlier turns, so only what's new
+                # is sent. If the thread is gone, re-seed it from the UI history;
+                # if a run was cut off mid tool call, close the open calls first.
+                saved_messages = run_on_event_loop(agent_app.aget_state(config)).values.get("messages", [])
+                if not saved_messages:
+                    new_messages = messages_from_ui(st.session_state.messages)
+                else:
+                    new_messages = close_dangling_tool_calls(saved_messages) + [HumanMessage(content=prompt)]
+                inputs = {"messages": new_messages}
             
-            async def get_response():
-                final_state = None
-                async for event in agent_app.astream(inputs, config=config):
-                    final_state = event
-                return final_state['agent']['messages'][-1].content
-
-            try:
-                response_text = asyncio.run(get_response())
-                st.markdown(response_text)
-                st.session_state.messages.append({"role": "assistant", "content": response_text})
-            except Exception as e:
-                error_message = f"An unexpected error occurred: {e}"
-                st.error(error_message) # Corrected variable name from 'error__message' to 'error_message'
-                st.session_state.messages.append({"role": "assistant", "content": error_message})
\ No newline at end of file
+                def stream_reply():
+                    # Drive the graph's async token stream on the shared loop and
+                    # hand the assistant's text to the UI as it arrives. Chunks that
+                    # carry tool calls are skipped; tools still run inside the graph.
+                    events = agent_app.astream(inputs, config=config, stream_mode="messages").__aiter__()
+                    current_message_id = None
+                    try:
+                        while True:
+                            try:
+                                chunk, metadata = run_on_event_loop(events.__anext__())
+                            except StopAsyncIteration:
+                                break
+                            if metadata.get("langgraph_node") not in ("agent_fast", "agent_smart") or not isinstance(chunk, AIMessage):
+                                continue
+                            if chunk.tool_calls or getattr(chunk, "tool_call_chunks", None):
+                                continue
+                            if chunk.content:
+                                # Keep text from separate model calls (e.g. a preamble
+                                # before a tool call) visually apart
+                                if current_message_id is not None and chunk.id != current_message_id:
+                                    yield "\n\n"
+                                current_message_id = chunk.id
+                                yield chunk.content
+                    finally:
+                        run_on_event_loop(events.aclose())
+
+                try:
+                    st.write_stream(stream_reply)
+                    # Store only the final answer, not any preamble streamed before a tool call
+                    final_state = run_on_event_loop(agent_app.aget_state(config))
+                    response_text = final_state.values["messages"][-1].content
+                    st.session_state.messages.append({"role": "assistant", "content": response_text})
+                except Exception as e:
+                    error_message = f"An unexpected error occurred: {e}"
+                    st.error(error_message) # Corrected variable name from 'error__message' to 'error_message'
+                    st.session_state.messages.append({"role": "assistant", "content": error_message})
+
+chat_panel()
\ No newline at end of file
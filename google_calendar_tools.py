@@ -1,119 +1,226 @@
-import os.path
+import asyncio
+import threading
 import datetime as dt
 from typing import List
 
+import httpx
+import orjson
 from langchain_core.tools import tool
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 
 from dateutil.parser import parse as date_parse
 from tzlocal import get_localzone
 
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
+FREEBUSY_URL = "https://www.googleapis.com/calendar/v3/freeBusy"
+EVENTS_URL = "https://www.googleapis.com/calendar/v3/calendars/primary/events"
+TOKEN_REFRESH_MARGIN = dt.timedelta(seconds=60)
+SLOT_SECONDS = 3600
 
-def get_calendar_service():
-    """Initializes and returns a Google Calendar service object."""
-    creds = None
-    if os.path.exists("token.json"):
+# Concurrent tool calls share one Credentials object and one token.json
+_credentials = None
+_credentials_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+
+# Shared by every tool call; see _get_http_client()
+_http_client = None
+
+# Resolved once at import; get_localzone() reads /etc/localtime on every call.
+LOCAL_TZ = get_localzone()
+
+def _save_token(creds):
+    with open("token.json", "w") as token:
+        token.write(creds.to_json())
+
+def get_credentials():
+    """Returns the user's Google OAuth credentials, loading them on first use.
+
+    The first call can block on disk, a token refresh or the OAuth flow, so
+    async callers should go through get_access_token().
+    """
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            _credentials = _load_credentials()
+    return _credentials
+
+def _load_credentials():
+    try:
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
+    except FileNotFoundError:
+        creds = None
+    if creds and creds.expired and creds.refresh_token:
+        creds.refresh(Request())
+        _save_token(creds)
+    elif not creds or not creds.valid:
+        flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
+        creds = flow.run_local_server(port=0)
+        _save_token(creds)
+    # Otherwise token.json already holds exactly these credentials; don't rewrite it
+    return creds
+
+def _token_expiring(creds) -> bool:
+    if creds.expiry is None:
+        return False
+    # google-auth keeps expiry as a naive UTC datetime
+    now = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+    return creds.expiry - now < TOKEN_REFRESH_MARGIN
+
+def refresh_credentials_if_needed():
+    """Refreshes the cached credentials only when the access token is about to
+    expire, and persists token.json only when a refresh actually happened."""
+    creds = get_credentials()
+    with _refresh_lock:
+        # Another thread may have refreshed while we waited for the lock
+        if creds.refresh_token and _token_expiring(creds):
             creds.refresh(Request())
+            _save_token(creds)
+    return creds
+
+def _get_http_client() -> httpx.AsyncClient:
+    # Created lazily on the first tool call, so it binds to the app's shared event
+    # loop, then reused so Calendar requests keep their TCP/TLS connections.
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient()
+    return _http_client
+
+async def _calendar_post(url: str, body: dict) -> dict:
+    """POSTs a JSON body to the Calendar REST API, encoding and decoding with orjson."""
+    token = await get_access_token()
+    response = await _get_http_client().post(
+        url,
+        content=orjson.dumps(body),
+        headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+async def get_access_token() -> str:
+    """Returns a valid bearer token for the Calendar REST API calls."""
+    # Loading can block, so keep it off the event loop shared by every session
+    creds = _credentials if _credentials is not None else await asyncio.to_thread(get_credentials)
+    if _token_expiring(creds):
+        creds = await asyncio.to_thread(refresh_credentials_if_needed)
+    return creds.token
+
+def _parse_iso(value: str) -> dt.datetime:
+    """Parses an ISO 8601 timestamp, falling back to dateutil for anything the
+    model produces that isn't strictly ISO formatted."""
+    try:
+        return dt.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return date_parse(value)
+
+def _parse_window(start_time: str, end_time: str):
+    start_dt = _parse_iso(start_time)
+    end_dt = _parse_iso(end_time)
+
+    if start_dt.tzinfo is None:
+        start_dt = start_dt.replace(tzinfo=LOCAL_TZ)
+    if end_dt.tzinfo is None:
+        end_dt = end_dt.replace(tzinfo=LOCAL_TZ)
+    return start_dt, end_dt
+
+def _freebusy_body(start_dt, end_dt) -> dict:
+    return {
+        "timeMin": start_dt.isoformat(),
+        "timeMax": end_dt.isoformat(),
+        "timeZone": str(LOCAL_TZ),
+        "items": [{"id": "primary"}],
+    }
+
+def _format_availability(start_dt, end_dt, busy_slots: List[dict]) -> str:
+    """Turns the free/busy intervals of the primary calendar into 1-hour slots."""
+    if not busy_slots:
+        return f"The entire period from {start_dt.strftime('%I:%M %p')} to {end_dt.strftime('%I:%M %p')} is free. Suggest 1-hour slots."
+    
+    # Work in integer epoch seconds and only format the slots that are returned
+    start_ep = int(start_dt.timestamp())
+    end_ep = int(end_dt.timestamp())
+    busy = sorted(
+        (int(_parse_iso(b["start"]).timestamp()), int(_parse_iso(b["end"]).timestamp())) for b in busy_slots
+    )
+
+    # Collapse overlapping or touching intervals so the gaps below are exact
+    merged = []
+    for busy_start, busy_end in busy:
+        if merged and busy_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], busy_end))
         else:
-            flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
-    service = build("calendar", "v3", credentials=creds)
-    return service
+            merged.append((busy_start, busy_end))
+
+    free_gaps = []
+    current = start_ep
+    for busy_start, busy_end in merged:
+        if current < busy_start:
+            free_gaps.append((current, min(busy_start, end_ep)))
+        current = max(current, busy_end)
+    free_gaps.append((current, end_ep))
+
+    slot_starts = [s for free_start, free_end in free_gaps for s in range(free_start, free_end - SLOT_SECONDS + 1, SLOT_SECONDS)]
+
+    tz = start_dt.tzinfo
+    available_slots = [
+        f"{dt.datetime.fromtimestamp(s, tz).strftime('%I:%M %p')} - {dt.datetime.fromtimestamp(s + SLOT_SECONDS, tz).strftime('%I:%M %p')}"
+        for s in slot_starts
+    ]
+
+    if not available_slots:
+        return "No 1-hour slots are available in the requested timeframe."
+
+    return f"Here are the available 1-hour slots: {', '.join(available_slots)}. Please suggest these to the user."
 
 @tool
-def check_availability(start_time: str, end_time: str) -> str:
+async def check_availability(start_time: str, end_time: str) -> str:
     """
     Checks for free time slots in a Google Calendar between a given start and end time.
     This tool handles timezones automatically.
     """
+    # Talks to the REST endpoint directly so the request doesn't block the event
+    # loop; when the model asks for several windows in one turn, ToolNode awaits
+    # these concurrently instead of one after the other.
     try:
-        service = get_calendar_service()
-        start_dt = date_parse(start_time)
-        end_dt = date_parse(end_time)
-        local_tz = get_localzone()
-
-        if start_dt.tzinfo is None:
-            start_dt = start_dt.replace(tzinfo=local_tz)
-        if end_dt.tzinfo is None:
-            end_dt = end_dt.replace(tzinfo=local_tz)
-
-        start_iso = start_dt.isoformat()
-        end_iso = end_dt.isoformat()
-        
-        events_result = (
-            service.events()
-            .list(
-                calendarId="primary",
-                timeMin=start_iso,
-                timeMax=end_iso,
-                singleEvents=True,
-                orderBy="startTime",
-            )
-            .execute()
-        )
-        busy_slots = events_result.get("items", [])
-
-        if not busy_slots:
-            return f"The entire period from {start_dt.strftime('%I:%M %p')} to {end_dt.strftime('%I:%M %p')} is free. Suggest 1-hour slots."
-        
-        available_slots = []
-        current_time = start_dt
-
-        for event in busy_slots:
-            event_start = date_parse(event["start"].get("dateTime"))
-            if current_time < event_start:
-                while current_time + dt.timedelta(hours=1) <= event_start:
-                    slot_end = current_time + dt.timedelta(hours=1)
-                    available_slots.append(f"{current_time.strftime('%I:%M %p')} - {slot_end.strftime('%I:%M %p')}")
-                    current_time += dt.timedelta(hours=1)
-            current_time = max(current_time, date_parse(event["end"].get("dateTime")))
-
-        while current_time + dt.timedelta(hours=1) <= end_dt:
-            slot_end = current_time + dt.timedelta(hours=1)
-            available_slots.append(f"{current_time.strftime('%I:%M %p')} - {slot_end.strftime('%I:%M %p')}")
-            current_time += dt.timedelta(hours=1)
-
-        if not available_slots:
-            return "No 1-hour slots are available in the requested timeframe."
-
-        return f"Here are the available 1-hour slots: {', '.join(available_slots)}. Please suggest these to the user."
+        start_dt, end_dt = _parse_window(start_time, end_time)
+
+        # freebusy only returns the busy intervals, already sorted, instead of
+        # full event objects we would otherwise download and ignore.
+        freebusy_result = await _calendar_post(FREEBUSY_URL, _freebusy_body(start_dt, end_dt))
+        primary = freebusy_result["calendars"]["primary"]
+        # A failed lookup still comes back as HTTP 200 with an empty busy list
+        if primary.get("errors"):
+            raise RuntimeError(f"freeBusy lookup failed: {primary['errors']}")
+        busy_slots = primary.get("busy", [])
+        return _format_availability(start_dt, end_dt, busy_slots)
 
+    except httpx.HTTPStatusError as e:
+        # Keep Google's error body; it says why the request was rejected
+        print(f"ERROR in check_availability: {e}\n{e.response.text}")
+        return "An error occurred while checking the calendar. Please try again or specify a different time."
     except Exception as e:
         print(f"ERROR in check_availability: {e}") 
         return "An error occurred while checking the calendar. Please try again or specify a different time."
 
 @tool
-def book_appointment(start_time: str, end_time: str, summary: str, description: str = "") -> str:
+async def book_appointment(start_time: str, end_time: str, summary: str, description: str = "") -> str:
     """Books an appointment on the user's primary Google Calendar."""
     try:
-        service = get_calendar_service()
-        start_dt = date_parse(start_time)
-        end_dt = date_parse(end_time)
-        local_tz = get_localzone()
-        
-        if start_dt.tzinfo is None:
-            start_dt = start_dt.replace(tzinfo=local_tz)
-        if end_dt.tzinfo is None:
-            end_dt = end_dt.replace(tzinfo=local_tz)
+        start_dt, end_dt = _parse_window(start_time, end_time)
 
         event = {
             "summary": summary,
             "description": description,
-            "start": {"dateTime": start_dt.isoformat(), "timeZone": str(local_tz)},
-            "end": {"dateTime": end_dt.isoformat(), "timeZone": str(local_tz)},
+            "start": {"dateTime": start_dt.isoformat(), "timeZone": str(LOCAL_TZ)},
+            "end": {"dateTime": end_dt.isoformat(), "timeZone": str(LOCAL_TZ)},
         }
-        created_event = service.events().insert(calendarId="primary", body=event).execute()
+        created_event = await _calendar_post(EVENTS_URL, event)
         return f"Success! The appointment '{summary}' has been booked for {start_dt.strftime('%A, %B %d at %I:%M %p')}. The event link is: {created_event.get('htmlLink')}"
+    except httpx.HTTPStatusError as e:
+        # Keep Google's error body; it says why the request was rejected
+        print(f"ERROR in book_appointment: {e}\n{e.response.text}")
+        return "An error occurred while booking the appointment. Please check the details and try again."
     except Exception as e:
         print(f"ERROR in book_appointment: {e}")
         return "An error occurred while booking the appointment. Please check the details and try again."
\ No newline at end of file